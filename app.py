@@ -1,12 +1,36 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
 import github_ops
 import llm_handler
 from gtts import gTTS
-import io
-import base64
+import os
+import re
+import json
+import hashlib
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 app = Flask(__name__)
 
+# Synthesized MP3s are stored here, named by the SHA-256 of their input
+TTS_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp', 'tts')
+TTS_LANG = 'en'
+TTS_SLOW = True
+AUDIO_ID_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Files are independent, so their fetch/apply/push cycles run concurrently
+MAX_APPLY_WORKERS = 8
+apply_executor = ThreadPoolExecutor(max_workers=MAX_APPLY_WORKERS)
+# LLM calls run here so the SSE generator can forward tokens while they stream
+llm_executor = ThreadPoolExecutor(max_workers=16)
+
+MAX_TTS_REQUESTS = 512
+
+# Texts awaiting synthesis: audio id -> (text, lang, slow), oldest evicted first
+tts_requests = OrderedDict()
+tts_lock = threading.Lock()
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -57,77 +81,162 @@ def chat():
     
     history = data.get('history', [])
     user_msg = data.get('message')
+    session_id = data.get('sessionId')
 
-    # 1. Fetch Repo Context
-    try:
-        repo_context = github_ops.get_repo_structure(gh_token, gh_user, gh_repo)
-    except Exception as e:
-        return jsonify({"error": f"GitHub Error: {str(e)}"}), 500
+    # Per-request file cache shared by the context fetch and the change loop
+    file_cache = {}
 
-    # 2. Query LLM
-    llm_response = llm_handler.query_llm(provider, api_key, model, history, repo_context, user_msg)
-    
-    # 3. Process Changes
-    changes = llm_response.get('changes', [])
-    execution_log = []
-
-    if changes:
-        # Group by file to minimize API calls
-        changes_by_file = {}
-        for change in changes:
-            fname = change['file']
-            if fname not in changes_by_file:
-                changes_by_file[fname] = []
-            changes_by_file[fname].append(change)
-
-        for fname, file_changes in changes_by_file.items():
+    def generate():
+        # 1. Fetch Repo Context
+        yield sse_event("repo_fetch_start")
+        try:
+            repo_context = github_ops.get_repo_structure(gh_token, gh_user, gh_repo, cache=file_cache)
+        except Exception as e:
+            yield sse_event("error", error=f"GitHub Error: {str(e)}")
+            return
+
+        # 2. Query LLM, forwarding streamed tokens as they arrive
+        yield sse_event("llm_start")
+        tokens = queue.Queue()
+
+        def run_llm():
             try:
-                # Fetch specific file content
-                content, sha = github_ops.get_file_content(gh_token, gh_user, gh_repo, fname)
-                
-                # Handle case where file doesn't exist (for new file creation)
-                if content is None: content = "" 
-                
-                # Apply Logic
-                new_content = github_ops.apply_changes_locally(content, file_changes)
-                
-                if new_content is None:
-                    # Logic to delete file via API
-                    if sha: # Can only delete if it exists remotely
-                        github_ops.delete_file_from_github(gh_token, gh_user, gh_repo, fname, sha)
-                        execution_log.append(f"Deleted {fname}")
-                    else:
-                        execution_log.append(f"Skipped delete {fname} (File not found)")
-                else:
+                return llm_handler.query_llm(
+                    provider, api_key, model, history, repo_context, user_msg,
+                    stream_callback=tokens.put, session_id=session_id
+                )
+            finally:
+                tokens.put(None)  # end-of-stream marker
+
+        llm_future = llm_executor.submit(run_llm)
+        for token in iter(tokens.get, None):
+            yield sse_event("token", text=token)
+        try:
+            llm_response = llm_future.result()
+        except Exception as e:
+            yield sse_event("error", error=f"LLM Error: {str(e)}")
+            return
+        
+        # 3. Register audio for on-demand synthesis; client streams it by URL
+        message = llm_response.get('message', "Processed")
+        audio_url = f"/api/tts/{register_audio(message)}.mp3"
+        yield sse_event("llm_done", response=message)
+
+        # 4. Process Changes
+        changes = llm_response.get('changes', [])
+        execution_log = []
+
+        if changes:
+            # Group by file to minimize API calls
+            changes_by_file = {}
+            for change in changes:
+                fname = change['file']
+                if fname not in changes_by_file:
+                    changes_by_file[fname] = []
+                changes_by_file[fname].append(change)
+
+            # Each write is a commit on the branch; GitHub rejects concurrent ones (409)
+            write_lock = threading.Lock()
+
+            def apply_one(fname, file_changes):
+                try:
+                    # Fetch specific file content
+                    content, sha = github_ops.get_file_content(gh_token, gh_user, gh_repo, fname, cache=file_cache)
+                    
+                    # Handle case where file doesn't exist (for new file creation)
+                    if content is None: content = "" 
+                    
+                    # Apply Logic
+                    new_content = github_ops.apply_changes_locally(content, file_changes)
+                    
+                    if new_content is None:
+                        # Logic to delete file via API
+                        if sha: # Can only delete if it exists remotely
+                            with write_lock:
+                                github_ops.delete_file_from_github(gh_token, gh_user, gh_repo, fname, sha, cache=file_cache)
+                            return f"Deleted {fname}"
+                        return f"Skipped delete {fname} (File not found)"
+                    
                     # Push to GitHub
-                    github_ops.push_to_github(gh_token, gh_user, gh_repo, fname, new_content, sha)
-                    execution_log.append(f"Updated {fname}")
-            except Exception as e:
-                execution_log.append(f"Failed to update {fname}: {str(e)}")
-
-    return jsonify({
-        "response": llm_response.get('message', "Processed"),
-        "execution_log": execution_log,
-        "audio": generate_audio(llm_response.get('message', "Processed"))
-    })
-
-def generate_audio(text):
-    """Generate audio from text using gTTS and return as base64."""
+                    with write_lock:
+                        github_ops.push_to_github(gh_token, gh_user, gh_repo, fname, new_content, sha, cache=file_cache)
+                    return f"Updated {fname}"
+                except Exception as e:
+                    return f"Failed to update {fname}: {str(e)}"
+
+            futures = {
+                apply_executor.submit(apply_one, fname, file_changes): fname
+                for fname, file_changes in changes_by_file.items()
+            }
+            # Report each file as soon as it lands
+            for future in as_completed(futures):
+                yield sse_event("file_updated", file=futures[future], log=future.result())
+            # Keep the log in the order the LLM listed the files
+            execution_log = [future.result() for future in futures]
+
+        yield sse_event("done", response=message, execution_log=execution_log, audio_url=audio_url)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def sse_event(event, **payload):
+    """Format one Server-Sent Events message carrying a JSON payload."""
+    return f"data: {json.dumps({'event': event, **payload})}\n\n"
+
+def register_audio(text, lang=TTS_LANG, slow=TTS_SLOW):
+    """Remember text for later synthesis and return its audio id."""
+    audio_id = hashlib.sha256(f"{lang}|{slow}|{text}".encode('utf-8')).hexdigest()
+    
+    with tts_lock:
+        tts_requests[audio_id] = (text, lang, slow)
+        tts_requests.move_to_end(audio_id)
+        if len(tts_requests) > MAX_TTS_REQUESTS:
+            tts_requests.popitem(last=False)
+    return audio_id
+
+def _audio_path(audio_id):
+    return os.path.join(TTS_CACHE_DIR, f"{audio_id}.mp3")
+
+def _stream_audio(audio_id, text, lang, slow):
+    """Yield MP3 chunks straight from gTTS, saving them to the disk cache as they pass."""
+    path = _audio_path(audio_id)
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    
     try:
-        # Create gTTS object
-        tts = gTTS(text=text, lang='en', slow=True)
-        
-        # Save to BytesIO object
-        audio_fp = io.BytesIO()
-        tts.write_to_fp(audio_fp)
-        audio_fp.seek(0)
-        
-        # Encode to base64
-        audio_base64 = base64.b64encode(audio_fp.read()).decode('utf-8')
-        return audio_base64
+        tts = gTTS(text=text, lang=lang, slow=slow)
+        with open(tmp_path, 'wb') as f:
+            for chunk in tts.stream():
+                f.write(chunk)
+                yield chunk
+        # Only publish complete MP3s; readers never see a partial file
+        os.replace(tmp_path, path)
     except Exception as e:
         print(f"Audio generation error: {str(e)}")
-        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@app.route('/api/tts/<audio_id>.mp3', methods=['GET'])
+def get_audio(audio_id):
+    """Serve cached audio, or stream it from gTTS on first request."""
+    if not AUDIO_ID_RE.match(audio_id):
+        return jsonify({"error": "Invalid audio id"}), 400
+    
+    path = _audio_path(audio_id)
+    if os.path.exists(path):
+        return send_file(path, mimetype='audio/mpeg')
+    
+    with tts_lock:
+        pending = tts_requests.get(audio_id)
+    if pending is None:
+        return jsonify({"error": "Audio not found"}), 404
+    
+    text, lang, slow = pending
+    return Response(stream_with_context(_stream_audio(audio_id, text, lang, slow)), mimetype='audio/mpeg')
 
 @app.route('/api/heartbeat', methods=['GET'])
 def heartbeat():
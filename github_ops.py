@@ -1,12 +1,172 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
 import difflib
+import ijson
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-def get_file_content(token, owner, repo, path, branch="main"):
-    """Fetches file content from GitHub."""
+# Cap concurrent GitHub fetches (shared by all requests) to stay well inside
+# GitHub's rate limits
+MAX_FETCH_WORKERS = 16
+# Retries (with exponential backoff) when GitHub throttles a request
+MAX_THROTTLE_RETRIES = 3
+# Start pacing requests once a token has fewer calls than this left,
+# and never sleep longer than MAX_THROTTLE_SLEEP seconds at a time
+MIN_RATE_LIMIT_REMAINING = 50
+MAX_THROTTLE_SLEEP = 60
+# Files requested per GraphQL query (keeps us under GitHub's node limits)
+GRAPHQL_BATCH_SIZE = 100
+
+# Upper bound on the repo context sent to the LLM, and how much of an
+# oversized file to keep (first and last N lines) when it doesn't fit
+MAX_CONTEXT_BYTES = 200_000
+TRUNCATE_KEEP_LINES = 20
+# Generated lockfiles: large, noisy and never useful as LLM context
+SKIPPED_FILES = frozenset({
+    'package-lock.json', 'yarn.lock', 'pnpm-lock.yaml', 'poetry.lock',
+    'Pipfile.lock', 'Cargo.lock', 'composer.lock', 'Gemfile.lock',
+})
+
+# Known binary formats: listed in the context by name but never downloaded
+_BINARY_EXT_RE = re.compile(
+    r'\.(png|jpe?g|gif|bmp|ico|webp|pdf|zip|gz|tgz|bz2|xz|7z|rar|jar|whl|'
+    r'exe|dll|so|dylib|o|a|pyc|class|woff2?|ttf|otf|eot|mp3|mp4|wav|ogg|mov|avi|sqlite|db)$',
+    re.IGNORECASE
+)
+
+# Whitespace sequences rewritten by normalize_whitespace
+_NORMALIZE_RE = re.compile(r'\r\n|\t')
+
+# (owner, repo, path, branch) -> (etag, content, sha) for conditional GETs,
+# least recently used evicted first
+MAX_ETAG_CACHE_ENTRIES = 2048
+_etag_cache = OrderedDict()
+_etag_lock = threading.Lock()
+
+# Shared session so TCP/TLS connections are kept alive and pooled across calls
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+_session.headers.update({"Accept": "application/vnd.github.v3+json"})
+
+class GitHubClient:
+    """
+    Wraps a requests.Session with client-side rate limiting.
+    Tracks X-RateLimit-Remaining/Reset per token and API (REST vs GraphQL),
+    pauses before a request when the budget is nearly spent, and retries
+    throttled (403/429) responses honoring Retry-After.
+    """
+    
+    def __init__(self, session):
+        self.session = session
+        # (authorization, resource) -> (remaining, reset_at)
+        self._limits = {}
+        self._lock = threading.Lock()
+    
+    def request(self, method, url, **kwargs):
+        headers = kwargs.get('headers') or {}
+        resource = 'graphql' if url.endswith('/graphql') else 'core'
+        limit_key = (headers.get('Authorization'), resource)
+        
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            self._wait_for_budget(limit_key)
+            response = self.session.request(method, url, **kwargs)
+            self._record_limits(limit_key, response)
+            
+            if attempt == MAX_THROTTLE_RETRIES or not self._is_throttled(response):
+                return response
+            response.close()
+            time.sleep(self._retry_delay(response, attempt))
+    
+    def _wait_for_budget(self, limit_key):
+        with self._lock:
+            remaining, reset_at = self._limits.get(limit_key, (None, 0))
+        if remaining is not None and remaining < MIN_RATE_LIMIT_REMAINING:
+            # Spread the calls that are left evenly over the rest of the window
+            delay = min((reset_at - time.time()) / max(remaining, 1), MAX_THROTTLE_SLEEP)
+            if delay > 0:
+                time.sleep(delay)
+    
+    def _record_limits(self, limit_key, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset_at = response.headers.get('X-RateLimit-Reset')
+        if remaining is not None and reset_at is not None:
+            with self._lock:
+                self._limits[limit_key] = (int(remaining), float(reset_at))
+    
+    @staticmethod
+    def _is_throttled(response):
+        if response.status_code == 429:
+            return True
+        # 403 is also used for permission errors; only retry rate limiting
+        return response.status_code == 403 and (
+            'Retry-After' in response.headers
+            or response.headers.get('X-RateLimit-Remaining') == '0'
+        )
+    
+    @staticmethod
+    def _retry_delay(response, attempt):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), MAX_THROTTLE_SLEEP)
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            reset_at = float(response.headers.get('X-RateLimit-Reset', 0))
+            return min(max(reset_at - time.time(), 1), MAX_THROTTLE_SLEEP)
+        return min(2 ** attempt, MAX_THROTTLE_SLEEP)
+
+_client = GitHubClient(_session)
+
+# Long-lived pool for bulk fetches: threads are reused across requests and the
+# total number of in-flight GitHub calls stays bounded under concurrent chats
+_executor = ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS)
+
+def _request(method, url, **kwargs):
+    """Send a GitHub API request through the shared rate-limited client."""
+    return _client.request(method, url, **kwargs)
+
+def get_file_content(token, owner, repo, path, branch="main", cache=None):
+    """
+    Fetches file content from GitHub.
+    cache is an optional per-request dict of (owner, repo, path, branch) ->
+    (content, sha); hits skip the network entirely and misses are stored.
+    """
+    cache_key = (owner, repo, path, branch)
+    if cache is not None and cache_key in cache:
+        return cache[cache_key]
+    
+    content, file_sha = _fetch_file_content(token, owner, repo, path, branch)
+    if cache is not None and content is not None:
+        cache[cache_key] = (content, file_sha)
+    return content, file_sha
+
+def _fetch_file_content(token, owner, repo, path, branch="main"):
+    """Fetches one file via the contents API, revalidating with a cached ETag."""
     url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}?ref={branch}"
-    headers = {"Authorization": f"Bearer {token}", "Accept": "application/vnd.github.v3+json"}
-    response = requests.get(url, headers=headers)
+    headers = {"Authorization": f"Bearer {token}"}
+    
+    # Revalidate with the cached ETag; 304s don't count against the rate limit
+    cache_key = (owner, repo, path, branch)
+    with _etag_lock:
+        cached = _etag_cache.get(cache_key)
+        if cached:
+            _etag_cache.move_to_end(cache_key)
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    
+    response = _request('GET', url, headers=headers)
+    
+    if response.status_code == 304 and cached:
+        # Unchanged since last fetch - skip JSON parsing and base64 decoding
+        return cached[1], cached[2]
     
     if response.status_code == 200:
         content = response.json()
@@ -15,12 +175,20 @@ def get_file_content(token, owner, repo, path, branch="main"):
             # Decode base64 then try to decode as UTF-8
             file_bytes = base64.b64decode(content['content'])
             decoded_content = file_bytes.decode('utf-8')
-            return decoded_content, file_sha
         except UnicodeDecodeError:
             # Handle binary files (images, compiled code, etc.)
-            return f"[Binary File: {path}]", file_sha
+            decoded_content = f"[Binary File: {path}]"
         except Exception as e:
             return f"[Error reading file: {str(e)}]", file_sha
+        
+        etag = response.headers.get('ETag')
+        if etag:
+            with _etag_lock:
+                _etag_cache[cache_key] = (etag, decoded_content, file_sha)
+                _etag_cache.move_to_end(cache_key)
+                if len(_etag_cache) > MAX_ETAG_CACHE_ENTRIES:
+                    _etag_cache.popitem(last=False)
+        return decoded_content, file_sha
             
     return None, None
 
@@ -28,45 +196,164 @@ def get_file_list(token, owner, repo, branch="main"):
     """Fetches list of all files in the repository for file browser."""
     url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(url, headers=headers)
     
     files = []
-    if response.status_code == 200:
-        tree = response.json().get('tree', [])
-        for item in tree:
-            if item['type'] == 'blob':  # Only files, not directories
+    with _request('GET', url, headers=headers, stream=True) as response:
+        if response.status_code == 200:
+            for item in iter_tree_blobs(response):  # Only files, not directories
                 files.append({
                     'path': item['path'],
                     'size': item.get('size', 0)
                 })
-    else:
-        raise Exception(f"GitHub API error: {response.status_code} - {response.text}")
+        else:
+            raise Exception(f"GitHub API error: {response.status_code} - {response.text}")
     
     return files
 
-def get_repo_structure(token, owner, repo, branch="main"):
-    """Fetches all file paths and their contents for context."""
+def get_repo_structure(token, owner, repo, branch="main", cache=None):
+    """
+    Fetches all file paths and their contents for context.
+    If cache is given, every fetched (content, sha) is stored in it for
+    later get_file_content calls in the same request.
+    """
     url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(url, headers=headers)
     
-    files_context = ""
-    if response.status_code == 200:
-        tree = response.json().get('tree', [])
-        for item in tree:
+    with _request('GET', url, headers=headers, stream=True) as response:
+        if response.status_code != 200:
+            return ""
+        # Include ALL files except lockfiles; binaries are named, not fetched
+        paths = []
+        fetch_paths = []
+        for item in iter_tree_blobs(response):
             path = item['path']
-            
-            # Check if it's a blob (file)
-            if item['type'] == 'blob':
-                # No longer filtering by extension - include ALL files
-                content, _ = get_file_content(token, owner, repo, path, branch)
-                if content:
-                    files_context += f"\n{'='*60}\n"
-                    files_context += f"FILE: {path}\n"
-                    files_context += f"{'='*60}\n"
-                    files_context += content + "\n"
+            if path.rsplit('/', 1)[-1] in SKIPPED_FILES:
+                continue
+            paths.append(path)
+            if not _BINARY_EXT_RE.search(path):
+                fetch_paths.append(path)
+    
+    if not paths:
+        return ""
+    
+    contents = {}
+    if fetch_paths:
+        try:
+            fetched = get_contents_graphql(token, owner, repo, fetch_paths, branch)
+        except Exception as e:
+            print(f"GraphQL fetch failed, falling back to REST: {str(e)}")
+            fetched = _get_contents_rest(token, owner, repo, fetch_paths, branch)
+        contents = dict(zip(fetch_paths, fetched))
+    
+    parts = []
+    total_bytes = 0
+    for path in paths:
+        # Same placeholder get_file_content produces for binary files
+        content, sha = contents.get(path, (f"[Binary File: {path}]", None))
+        if not content:
+            continue
+        if cache is not None and sha:
+            cache[(owner, repo, path, branch)] = (content, sha)
+        
+        header = f"\n{'='*60}\nFILE: {path}\n{'='*60}\n"
+        block = header + content + "\n"
+        block_bytes = len(block.encode('utf-8'))
+        
+        if total_bytes + block_bytes > MAX_CONTEXT_BYTES:
+            # Over budget: keep only the head and tail of the file
+            block = header + truncate_lines(content, TRUNCATE_KEEP_LINES) + "\n"
+            block_bytes = len(block.encode('utf-8'))
+            if total_bytes + block_bytes > MAX_CONTEXT_BYTES:
+                continue
+        
+        parts.append(block)
+        total_bytes += block_bytes
                         
-    return files_context
+    return "".join(parts)
+
+def truncate_lines(content, keep):
+    """Keep the first and last `keep` lines of content with a marker in between."""
+    lines = content.split('\n')
+    if len(lines) <= 2 * keep:
+        return content
+    
+    omitted = len(lines) - 2 * keep
+    return '\n'.join(lines[:keep] + [f"... (truncated {omitted} lines) ..."] + lines[-keep:])
+
+def iter_tree_blobs(response):
+    """Stream blob entries from a streamed git/trees response without loading the whole tree."""
+    # Let urllib3 undo gzip/deflate before ijson reads the raw stream
+    response.raw.decode_content = True
+    for item in ijson.items(response.raw, 'tree.item'):
+        if item['type'] == 'blob':
+            yield item
+
+def get_contents_graphql(token, owner, repo, paths, branch="main"):
+    """
+    Fetches the text of many files with batched GraphQL queries.
+    Returns a list of (content, sha) in the same order as paths
+    ((None, None) if missing). Truncated blobs come back with sha None so
+    they are never mistaken for the full file.
+    """
+    batches = [
+        paths[offset:offset + GRAPHQL_BATCH_SIZE]
+        for offset in range(0, len(paths), GRAPHQL_BATCH_SIZE)
+    ]
+    # Large repos need several queries; run them side by side
+    results = _executor.map(
+        lambda batch: _get_contents_graphql_batch(token, owner, repo, batch, branch), batches
+    )
+    return [content for batch_contents in results for content in batch_contents]
+
+def _get_contents_graphql_batch(token, owner, repo, batch, branch="main"):
+    """Fetches up to GRAPHQL_BATCH_SIZE files in a single GraphQL query."""
+    url = "https://api.github.com/graphql"
+    headers = {"Authorization": f"Bearer {token}"}
+    
+    # One aliased object() lookup per file: f0, f1, ...
+    fields = "\n".join(
+        f"f{i}: object(expression: {json.dumps(f'{branch}:{path}')}) "
+        "{ ... on Blob { oid text isBinary isTruncated } }"
+        for i, path in enumerate(batch)
+    )
+    query = (
+        "query($owner: String!, $name: String!) {\n"
+        "  repository(owner: $owner, name: $name) {\n"
+        f"{fields}\n"
+        "  }\n"
+        "}"
+    )
+    payload = {"query": query, "variables": {"owner": owner, "name": repo}}
+    
+    response = _request('POST', url, headers=headers, json=payload)
+    if response.status_code != 200:
+        raise Exception(f"GitHub GraphQL error: {response.status_code} - {response.text}")
+    
+    result = response.json()
+    if result.get('errors'):
+        raise Exception(f"GitHub GraphQL error: {result['errors']}")
+    
+    repository = result['data']['repository']
+    contents = []
+    for i, path in enumerate(batch):
+        blob = repository.get(f"f{i}")
+        if not blob:
+            contents.append((None, None))
+        elif blob.get('isBinary'):
+            # Match get_file_content's placeholder for binary files
+            contents.append((f"[Binary File: {path}]", blob.get('oid')))
+        elif blob.get('isTruncated'):
+            contents.append((blob.get('text'), None))
+        else:
+            contents.append((blob.get('text'), blob.get('oid')))
+    
+    return contents
+
+def _get_contents_rest(token, owner, repo, paths, branch="main"):
+    """Fetches many (content, sha) pairs concurrently via the contents API, preserving order."""
+    return list(_executor.map(
+        lambda p: get_file_content(token, owner, repo, p, branch), paths
+    ))
 
 def normalize_whitespace(text):
     """Normalize whitespace for more flexible matching."""
@@ -76,19 +363,50 @@ def normalize_whitespace(text):
     text = text.replace('\t', '    ')
     return text
 
-def find_in_content(content, search_text):
+def normalize_with_offsets(text):
     """
-    Find search_text in content with normalized whitespace.
-    Returns (index, match_found) or (None, False)
+    Normalize whitespace like normalize_whitespace, also returning an offset map.
+    offsets[i] is the index in text of normalized character i; the final entry
+    is len(text) so match ends map back too.
     """
-    normalized_content = normalize_whitespace(content)
-    normalized_search = normalize_whitespace(search_text)
+    if '\t' not in text and '\r\n' not in text:
+        # Common case: nothing to rewrite, so the map is the identity (no list built)
+        return text, range(len(text) + 1)
     
-    index = normalized_content.find(normalized_search)
-    if index != -1:
-        return index, True
+    parts = []
+    offsets = []
+    pos = 0
     
-    return None, False
+    for match in _NORMALIZE_RE.finditer(text):
+        start = match.start()
+        parts.append(text[pos:start])
+        offsets.extend(range(pos, start))
+        
+        if match.group() == '\t':
+            # One tab becomes 4 spaces, all pointing at the tab
+            parts.append('    ')
+            offsets.extend((start,) * 4)
+        else:
+            # \r\n becomes \n, pointing at the \r so the pair is kept together
+            parts.append('\n')
+            offsets.append(start)
+        pos = match.end()
+    
+    parts.append(text[pos:])
+    offsets.extend(range(pos, len(text) + 1))
+    return "".join(parts), offsets
+
+def locate_in_content(search_text, normalized_content, offsets):
+    """
+    Find search_text in normalized content and map the match to original indices.
+    Returns (start, end) in the original content, or None if not found.
+    """
+    normalized_search = normalize_whitespace(search_text)
+    norm_index = normalized_content.find(normalized_search)
+    if norm_index == -1:
+        return None
+    
+    return offsets[norm_index], offsets[norm_index + len(normalized_search)]
 
 def find_similar_text(content, search_text, n=3):
     """Find similar text in content for helpful error messages."""
@@ -114,6 +432,37 @@ def find_similar_text(content, search_text, n=3):
     
     return suggestions
 
+def _conflicts_with_pending(content, pending, start, end, search_text=None):
+    """
+    True if a new edit at [start, end) touches a pending edit, or if its anchor
+    could match text produced by one - either way the pending edits must be
+    applied first to keep in-order semantics.
+    """
+    normalized_search = normalize_whitespace(search_text) if search_text else None
+    # A match spanning an edit lies within this many original chars of it
+    margin = 2 * len(normalized_search) if normalized_search else 0
+    
+    for pending_start, pending_end, text in pending:
+        if start <= pending_end and pending_start <= end:
+            return True
+        if normalized_search:
+            window = (content[max(0, pending_start - margin):pending_start]
+                      + text + content[pending_end:pending_end + margin])
+            if normalized_search in normalize_whitespace(window):
+                return True
+    return False
+
+def _apply_edits(content, edits):
+    """Apply non-overlapping (start, end, text) edits in a single pass over content."""
+    parts = []
+    pos = 0
+    for start, end, text in sorted(edits, key=lambda edit: edit[0]):
+        parts.append(content[pos:start])
+        parts.append(text)
+        pos = end
+    parts.append(content[pos:])
+    return "".join(parts)
+
 def apply_changes_locally(original_content, changes):
     """
     Applies chunk-based changes to content.
@@ -124,15 +473,40 @@ def apply_changes_locally(original_content, changes):
     - erase: Remove code chunk (same as replace with "")
     - write: Overwrite entire file
     - delete_file: Signal file deletion
+    
+    Independent edits are queued and spliced in with one join instead of
+    rebuilding the file per change. The queue is flushed first whenever a
+    change depends on a queued one, so results match applying them in order.
     """
     content = original_content
+    # Normalized once per content version and reused by every search
+    normalized_content, offsets = normalize_with_offsets(content)
+    # Edits resolved against content but not yet applied: (start, end, text)
+    pending = []
+    
+    def flush():
+        nonlocal content, normalized_content, offsets, pending
+        if pending:
+            content = _apply_edits(content, pending)
+            normalized_content, offsets = normalize_with_offsets(content)
+            pending = []
+    
+    def locate(search_text):
+        match = locate_in_content(search_text, normalized_content, offsets)
+        if pending and (match is None or _conflicts_with_pending(content, pending, *match, search_text)):
+            # The anchor may overlap, or only exist after, a queued edit
+            flush()
+            match = locate_in_content(search_text, normalized_content, offsets)
+        return match
     
     for change in changes:
         action = change.get('action')
         
         if action == 'write':
-            # Complete file overwrite
+            # Complete file overwrite; queued edits are superseded
             content = change.get('content', '')
+            normalized_content, offsets = normalize_with_offsets(content)
+            pending = []
             
         elif action == 'delete_file':
             # Signal deletion
@@ -146,26 +520,10 @@ def apply_changes_locally(original_content, changes):
                 print(f"Warning: Replace operation missing 'search' field")
                 continue
             
-            index, found = find_in_content(content, search_text)
+            match = locate(search_text)
             
-            if found:
-                # Calculate actual length to replace (accounting for normalization)
-                normalized_content = normalize_whitespace(content)
-                normalized_search = normalize_whitespace(search_text)
-                
-                # Find in normalized, replace in original
-                norm_index = normalized_content.find(normalized_search)
-                
-                # Map back to original indices (this is approximate but works well)
-                before_normalized = normalized_content[:norm_index]
-                before_original = content[:len(before_normalized)]
-                
-                # Find actual start in original
-                actual_start = len(before_original)
-                actual_end = actual_start + len(search_text)
-                
-                # Replace
-                content = content[:actual_start] + replace_text + content[actual_end:]
+            if match:
+                pending.append((match[0], match[1], replace_text))
             else:
                 # Provide helpful error message
                 suggestions = find_similar_text(content, search_text)
@@ -182,20 +540,10 @@ def apply_changes_locally(original_content, changes):
                 print(f"Warning: Erase operation missing 'search' field")
                 continue
                 
-            index, found = find_in_content(content, search_text)
+            match = locate(search_text)
             
-            if found:
-                normalized_content = normalize_whitespace(content)
-                normalized_search = normalize_whitespace(search_text)
-                norm_index = normalized_content.find(normalized_search)
-                
-                before_normalized = normalized_content[:norm_index]
-                before_original = content[:len(before_normalized)]
-                
-                actual_start = len(before_original)
-                actual_end = actual_start + len(search_text)
-                
-                content = content[:actual_start] + content[actual_end:]
+            if match:
+                pending.append((match[0], match[1], ""))
             else:
                 print(f"Warning: Could not find search text for erase operation")
                 
@@ -204,41 +552,34 @@ def apply_changes_locally(original_content, changes):
             insert_text = change.get('insert', '')
             position = change.get('position', 'after')  # 'before', 'after', 'start', 'end'
             
-            if position == 'start':
-                content = insert_text + content
-                
-            elif position == 'end':
-                content = content + insert_text
+            if position in ('start', 'end'):
+                offset = 0 if position == 'start' else len(content)
+                if _conflicts_with_pending(content, pending, offset, offset):
+                    flush()
+                    offset = 0 if position == 'start' else len(content)
+                pending.append((offset, offset, insert_text))
                 
             else:
                 if not search_text:
                     print(f"Warning: Insert operation missing 'search' anchor")
                     continue
                     
-                index, found = find_in_content(content, search_text)
+                match = locate(search_text)
                 
-                if found:
-                    normalized_content = normalize_whitespace(content)
-                    normalized_search = normalize_whitespace(search_text)
-                    norm_index = normalized_content.find(normalized_search)
-                    
-                    before_normalized = normalized_content[:norm_index]
-                    before_original = content[:len(before_normalized)]
-                    
-                    actual_start = len(before_original)
-                    
+                if match:
+                    actual_start, actual_end = match
                     if position == 'before':
-                        content = content[:actual_start] + insert_text + content[actual_start:]
+                        pending.append((actual_start, actual_start, insert_text))
                     else:  # after
-                        actual_end = actual_start + len(search_text)
-                        content = content[:actual_end] + insert_text + content[actual_end:]
+                        pending.append((actual_end, actual_end, insert_text))
                 else:
                     print(f"Warning: Could not find anchor text for insert operation")
 
+    flush()
     return content
 
-def push_to_github(token, owner, repo, file_path, new_content, sha, branch="main"):
-    """Push updated content to GitHub."""
+def push_to_github(token, owner, repo, file_path, new_content, sha, branch="main", cache=None):
+    """Push updated content to GitHub, priming cache with the new version."""
     url = f"https://api.github.com/repos/{owner}/{repo}/contents/{file_path}"
     headers = {"Authorization": f"Bearer {token}"}
     
@@ -250,11 +591,16 @@ def push_to_github(token, owner, repo, file_path, new_content, sha, branch="main
     if sha:
         data["sha"] = sha
 
-    response = requests.put(url, headers=headers, json=data)
-    return response.json()
+    response = _request('PUT', url, headers=headers, json=data)
+    result = response.json()
+    
+    if cache is not None and response.status_code in (200, 201):
+        # Later reads in this request get the pushed content without a GET
+        cache[(owner, repo, file_path, branch)] = (new_content, result['content']['sha'])
+    return result
 
-def delete_file_from_github(token, owner, repo, path, sha, branch="main"):
-    """Deletes a file from GitHub."""
+def delete_file_from_github(token, owner, repo, path, sha, branch="main", cache=None):
+    """Deletes a file from GitHub, dropping it from cache."""
     url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
     headers = {"Authorization": f"Bearer {token}"}
     
@@ -264,5 +610,7 @@ def delete_file_from_github(token, owner, repo, path, sha, branch="main"):
         "branch": branch
     }
     
-    response = requests.delete(url, headers=headers, json=data)
+    response = _request('DELETE', url, headers=headers, json=data)
+    if cache is not None:
+        cache.pop((owner, repo, path, branch), None)
     return response.status_code in [200, 204]
\ No newline at end of file
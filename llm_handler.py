@@ -1,6 +1,46 @@
 import google.generativeai as genai
-from openai import OpenAI
+from google.generativeai import client as genai_client
+from google.api_core import exceptions as api_exceptions
+from google.api_core import retry as api_retry
+from google.api_core import retry_async as api_retry_async
+import openai
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+import diskcache
+import hashlib
+import httpx
+import itertools
 import json
+import os
+import threading
+import weakref
+from collections import OrderedDict, deque
+
+# orjson parses the (often large) model output several times faster; the
+# stdlib json module is the fallback when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# tiktoken gives real token counts for the context budget; without it (or
+# when its encoding file can't be downloaded, e.g. offline) we fall back to
+# a ~4 chars per token estimate
+try:
+    import tiktoken
+    _ENC = tiktoken.get_encoding("cl100k_base")
+except Exception as e:
+    if not isinstance(e, ImportError):
+        print(f"tiktoken unavailable, estimating token counts: {str(e)}")
+    _ENC = None
+
+# sentence-transformers enables the semantic cache tier; without it only
+# exact-match caching is done
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
 
 SYSTEM_PROMPT = """
 You are an expert coding assistant with access to a GitHub repository.
@@ -133,90 +173,693 @@ Example 4 - Create new file:
   }]
 }
 
-Repository context provided below shows current file contents.
+The last message holds the repository context (current file contents),
+wrapped in <repo_context> tags. The user's request is the message just before it.
 """
 
-def query_llm(provider, api_key, model_name, history, repo_context, user_msg):
-    full_prompt = f"{repo_context}\n\nUser: {user_msg}"
+# Structured-output schema for Gemini, mirroring the JSON format described
+# in SYSTEM_PROMPT, so responses are guaranteed to parse
+RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "message": {"type": "STRING"},
+        "changes": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "action": {"type": "STRING"},
+                    "file": {"type": "STRING"},
+                    "search": {"type": "STRING"},
+                    "replace": {"type": "STRING"},
+                    "insert": {"type": "STRING"},
+                    "position": {"type": "STRING"},
+                    "content": {"type": "STRING"},
+                },
+                "required": ["action", "file"],
+            },
+        },
+    },
+    "required": ["message", "changes"],
+}
+
+# Generation parameters callers may override through gen_cfg
+GEN_CFG_KEYS = ("temperature", "top_p", "seed")
+
+# Default cap on in-flight provider calls in query_llm_batch
+MAX_CONCURRENT_REQUESTS = 16
+
+# Parsed responses keyed by SHA-256 of (provider, model, messages); identical
+# prompts within a day are answered from disk without calling the provider
+CACHE_TTL_SECONDS = 86400
+_CACHE = diskcache.Cache(os.path.expanduser("~/.cache/four_llm"))
+
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+
+# Provider clients are reused so their HTTP connection pools stay warm.
+# Sync clients: (provider, api_key) -> OpenAI. Gemini models: (api_key, model) -> model.
+# Async clients are bound to the event loop that created them, so they are
+# cached per loop and dropped with it. Keys are user-supplied, so each cache
+# keeps at most MAX_CACHED_CLIENTS, least recently used evicted first.
+MAX_CACHED_CLIENTS = 64
+_CLIENTS = OrderedDict()
+_GEMINI_MODELS = OrderedDict()
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+_ASYNC_HTTP_CLIENTS = weakref.WeakKeyDictionary()
+_last_gemini_key = None
+_clients_lock = threading.Lock()
+
+# One HTTP/2 connection pool shared by every OpenAI-compatible client, so
+# concurrent calls multiplex over a few warm connections instead of each
+# API key opening its own
+HTTP_TIMEOUT_SECONDS = 60
+HTTP_RETRIES = 2
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+_HTTP_CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(http2=True, retries=HTTP_RETRIES, limits=HTTP_LIMITS),
+    timeout=HTTP_TIMEOUT_SECONDS
+)
+
+# Transient provider failures (rate limits, overload, dropped connections)
+# are retried with exponential backoff by the SDKs themselves: the OpenAI
+# client honours max_retries, Gemini takes a google.api_core Retry.
+MAX_API_RETRIES = 4
+_GEMINI_RETRYABLE = api_retry.if_exception_type(
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+)
+_GEMINI_RETRY = api_retry.Retry(predicate=_GEMINI_RETRYABLE, initial=1.0, maximum=30.0, multiplier=2.0, timeout=120.0)
+_GEMINI_RETRY_ASYNC = api_retry_async.AsyncRetry(predicate=_GEMINI_RETRYABLE, initial=1.0, maximum=30.0, multiplier=2.0, timeout=120.0)
+
+# Errors from talking to a provider; these become an error message for the
+# user. Anything else is a bug and propagates to the caller.
+_API_ERRORS = (
+    httpx.HTTPError,
+    openai.APIError,
+    api_exceptions.GoogleAPIError,
+    genai.types.BlockedPromptException,
+    genai.types.StopCandidateException,
+)
+
+def _cached_client(cache, key, create):
+    """Return cache[key], creating it if missing and evicting the oldest entry past the cap."""
+    client = cache.get(key)
+    if client is None:
+        client = create()
+        cache[key] = client
+        if len(cache) > MAX_CACHED_CLIENTS:
+            cache.popitem(last=False)
+    cache.move_to_end(key)
+    return client
+
+def _get_deepseek_client(api_key):
+    with _clients_lock:
+        return _cached_client(_CLIENTS, ('deepseek', api_key), lambda: OpenAI(
+            api_key=api_key, base_url=DEEPSEEK_BASE_URL, http_client=_HTTP_CLIENT, max_retries=MAX_API_RETRIES
+        ))
+
+def _get_async_http_client(loop):
+    """The shared async connection pool for this event loop."""
+    http_client = _ASYNC_HTTP_CLIENTS.get(loop)
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(http2=True, retries=HTTP_RETRIES, limits=HTTP_LIMITS),
+            timeout=HTTP_TIMEOUT_SECONDS
+        )
+        _ASYNC_HTTP_CLIENTS[loop] = http_client
+    return http_client
+
+def _get_async_deepseek_client(api_key):
+    loop = asyncio.get_running_loop()
+    clients = _ASYNC_CLIENTS.setdefault(loop, OrderedDict())
+    return _cached_client(clients, api_key, lambda: AsyncOpenAI(
+        api_key=api_key, base_url=DEEPSEEK_BASE_URL, http_client=_get_async_http_client(loop),
+        max_retries=MAX_API_RETRIES
+    ))
+
+def _get_gemini_model(api_key, model_name, use_async=False):
+    global _last_gemini_key
+    with _clients_lock:
+        model = _cached_client(_GEMINI_MODELS, (api_key, model_name), lambda: genai.GenerativeModel(model_name))
+        # GenerativeModel picks up its API client lazily, on first call, from the
+        # global genai.configure state. Bind it here, while holding the lock, so
+        # a concurrent configure for another key can't attach that key instead.
+        needs_client = model._client is None or (use_async and model._async_client is None)
+        if needs_client:
+            # genai.configure is global; only redo it when the key actually changes
+            if api_key != _last_gemini_key:
+                genai.configure(api_key=api_key)
+                _last_gemini_key = api_key
+            if model._client is None:
+                model._client = genai_client.get_default_generative_client()
+            if use_async and model._async_client is None:
+                model._async_client = genai_client.get_default_generative_async_client()
+        return model
+
+def _loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def _dumps_sorted(obj):
+    """Serialize obj with sorted keys to bytes, for stable hashing."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True).encode('utf-8')
+
+def _cache_key(provider, model_name, messages, gen_cfg=None):
+    payload = _dumps_sorted([provider, model_name, messages, gen_cfg or {}])
+    return hashlib.sha256(payload).hexdigest()
+
+# Semantic cache: a question phrased differently from one already answered
+# against the same repo state, history and settings reuses that answer when
+# their embeddings' cosine similarity reaches SEMANTIC_CACHE_THRESHOLD.
+# Kept in memory, up to SEMANTIC_CACHE_SIZE answers per context.
+# Only pure answers (no "changes") are kept: near-identical instructions like
+# "set timeout to 10" vs "to 30" embed almost the same, and serving one's
+# edits for the other would commit the wrong change.
+SEMANTIC_CACHE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_SIZE = 256
+MAX_SEMANTIC_CONTEXTS = 64
+
+# context key -> (matrix of normalized query embeddings, parallel list of responses)
+_SEMANTIC_CACHE = OrderedDict()
+_semantic_lock = threading.Lock()
+_embedder = None
+# Set once the model fails to load, so the tier stays off instead of retrying
+_embedder_failed = False
+
+def _embed(text):
+    """
+    Normalized embedding of text, or None when the semantic tier is unavailable
+    (sentence-transformers missing, or the model can't be downloaded/loaded).
+    """
+    global _embedder, _embedder_failed
+    if SentenceTransformer is None or _embedder_failed:
+        return None
+    with _semantic_lock:
+        if _embedder is None and not _embedder_failed:
+            try:
+                _embedder = SentenceTransformer(SEMANTIC_CACHE_MODEL)
+            except Exception as e:
+                print(f"Semantic cache disabled, could not load {SEMANTIC_CACHE_MODEL}: {str(e)}")
+                _embedder_failed = True
+        if _embedder is None:
+            return None
+    try:
+        return _embedder.encode(text, normalize_embeddings=True).astype(np.float32)
+    except Exception as e:
+        print(f"Semantic cache embedding error: {str(e)}")
+        return None
+
+def _semantic_context_key(provider, model_name, messages, repo_context, gen_cfg=None):
+    """Everything in the prompt except the user's message (second to last)."""
+    return _cache_key(provider, model_name, [messages[:-2], repo_context], gen_cfg)
+
+def _semantic_get(context_key, embedding):
+    if embedding is None:
+        return None
+    with _semantic_lock:
+        entry = _SEMANTIC_CACHE.get(context_key)
+        if entry is None:
+            return None
+        _SEMANTIC_CACHE.move_to_end(context_key)
+        embeddings, responses = entry
+        # Embeddings are normalized, so the inner product is cosine similarity
+        scores = embeddings @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] >= SEMANTIC_CACHE_THRESHOLD and not responses[best].get('changes'):
+            return responses[best]
+    return None
+
+def _semantic_put(context_key, user_msg, result, embedding=None):
+    if result.get('changes'):
+        return
+    if embedding is None:
+        embedding = _embed(user_msg)
+        if embedding is None:
+            return
+    with _semantic_lock:
+        entry = _SEMANTIC_CACHE.get(context_key)
+        if entry is None:
+            embeddings, responses = np.empty((0, embedding.shape[0]), dtype=np.float32), []
+        else:
+            embeddings, responses = entry
+        embeddings = np.vstack([embeddings, embedding])[-SEMANTIC_CACHE_SIZE:]
+        responses = (responses + [result])[-SEMANTIC_CACHE_SIZE:]
+        _SEMANTIC_CACHE[context_key] = (embeddings, responses)
+        _SEMANTIC_CACHE.move_to_end(context_key)
+        if len(_SEMANTIC_CACHE) > MAX_SEMANTIC_CONTEXTS:
+            _SEMANTIC_CACHE.popitem(last=False)
+
+# Prompt tokens available in a 64k context window after reserving 8k for
+# output; the repo context gets what the system prompt, history and user
+# message leave over, up to MAX_CONTEXT_TOKENS
+MAX_PROMPT_TOKENS = 56000
+MAX_CONTEXT_TOKENS = 48000
+# File header written by github_ops.get_repo_structure
+_FILE_HEADER = f"\n{'='*60}\nFILE: "
+
+def _token_count(text):
+    """Token count with tiktoken's cl100k_base, or a ~4 chars per token estimate."""
+    if _ENC is not None:
+        return len(_ENC.encode(text, disallowed_special=()))
+    return len(text) // 4
+
+# The system prompt never changes, so count it once
+_SYSTEM_TOKEN_COUNT = _token_count(SYSTEM_PROMPT)
+
+def _budget_context(repo_context, user_msg, max_tokens=MAX_CONTEXT_TOKENS):
+    """
+    Trim repo_context to max_tokens, keeping files named in user_msg first
+    and then the rest in tree order. Dropped files are listed by path so the
+    model still knows they exist.
+    """
+    if _token_count(repo_context) <= max_tokens:
+        return repo_context
+    
+    blocks = [_FILE_HEADER + block for block in repo_context.split(_FILE_HEADER) if block]
+    paths = [block[len(_FILE_HEADER):].split('\n', 1)[0] for block in blocks]
+    
+    # Files the user mentions (by path or file name) are packed first
+    def mentioned(path):
+        return path in user_msg or path.rsplit('/', 1)[-1] in user_msg
+    order = sorted(range(len(blocks)), key=lambda i: not mentioned(paths[i]))
+    
+    kept = set()
+    used = 0
+    for i in order:
+        cost = _token_count(blocks[i])
+        if used + cost <= max_tokens:
+            kept.add(i)
+            used += cost
     
-    # Construct messages list from history (last 10) + current context
+    parts = [blocks[i] for i in range(len(blocks)) if i in kept]
+    omitted = [paths[i] for i in range(len(blocks)) if i not in kept]
+    if omitted:
+        parts.append(f"\n(Omitted for length: {', '.join(omitted)})\n")
+    return "".join(parts)
+
+# Chat turns kept per prompt, and how many server-side sessions to remember
+MAX_HISTORY_TURNS = 10
+MAX_SESSIONS = 256
+
+# session_id -> deque of already-translated {"role", "content"} turns, so a
+# session only appends its new turns instead of rebuilding the history
+_SESSION_MESSAGES = OrderedDict()
+_sessions_lock = threading.Lock()
+
+def _recent(history):
+    """
+    Iterate the last MAX_HISTORY_TURNS entries without copying. history may
+    be a list or, to cap it at append time, a deque(maxlen=MAX_HISTORY_TURNS).
+    """
+    return itertools.islice(history, max(0, len(history) - MAX_HISTORY_TURNS), None)
+
+def _translate_history(history):
+    """Client history entries ({"sender", "text"}) as chat messages."""
+    turns = []
+    for msg in _recent(history):
+        role = "user" if msg['sender'] == 'user' else "assistant"
+        turns.append({"role": role, "content": msg['text']})
+    return turns
+
+def _session_turns(session_id, history):
+    """Return a snapshot of the session's turns, seeding it from history if new."""
+    with _sessions_lock:
+        turns = _SESSION_MESSAGES.get(session_id)
+        if turns is None:
+            turns = deque(_translate_history(history), maxlen=MAX_HISTORY_TURNS)
+            _SESSION_MESSAGES[session_id] = turns
+            if len(_SESSION_MESSAGES) > MAX_SESSIONS:
+                _SESSION_MESSAGES.popitem(last=False)
+        _SESSION_MESSAGES.move_to_end(session_id)
+        return list(turns)
+
+def _remember_turn(session_id, user_msg, result):
+    """Append a completed exchange to the session's history."""
+    if not session_id:
+        return
+    with _sessions_lock:
+        turns = _SESSION_MESSAGES.get(session_id)
+        if turns is not None:
+            turns.append({"role": "user", "content": user_msg})
+            turns.append({"role": "assistant", "content": result.get('message', "")})
+
+def _build_messages(provider, history, repo_context, user_msg, session_id=None):
+    """Build the conversation directly in the shape the provider expects."""
+    if provider == 'gemini':
+        return _build_messages_gemini(history, repo_context, user_msg, session_id)
+    return _build_messages_openai(history, repo_context, user_msg, session_id)
+
+def _context_message(repo_context, user_msg, prompt_texts):
+    """Wrap repo_context, trimmed to the tokens prompt_texts and the system prompt leave free."""
+    used = _SYSTEM_TOKEN_COUNT + sum(_token_count(text) for text in prompt_texts)
+    max_tokens = max(0, min(MAX_CONTEXT_TOKENS, MAX_PROMPT_TOKENS - used))
+    repo_context = _budget_context(repo_context, user_msg, max_tokens)
+    return f"<repo_context>\n{repo_context}\n</repo_context>"
+
+def _build_messages_openai(history, repo_context, user_msg, session_id=None):
+    """
+    Construct messages list from history (last 10) + current context.
+    With a session_id, the server-side session history is used instead of
+    re-translating the client's history on every call.
+    The volatile repo context goes last, so the system prompt, history and
+    user message form a prefix that providers' prompt caching can reuse.
+    """
     messages = [{"role": "system", "content": SYSTEM_PROMPT}]
     
     # Add history (limited to last 10)
-    for msg in history[-10:]:
-        role = "user" if msg['sender'] == 'user' else "assistant"
-        messages.append({"role": role, "content": msg['text']})
+    if session_id:
+        messages.extend(_session_turns(session_id, history))
+    else:
+        messages.extend(_translate_history(history))
     
-    messages.append({"role": "user", "content": full_prompt})
+    messages.append({"role": "user", "content": user_msg})
+    prompt_texts = [message['content'] for message in messages[1:]]
+    messages.append({"role": "user", "content": _context_message(repo_context, user_msg, prompt_texts)})
+    return messages
+
+def _build_messages_gemini(history, repo_context, user_msg, session_id=None):
+    """Same conversation as _build_messages_openai in Gemini's {"role", "parts"} format."""
+    # Gemini gets the system prompt as the opening user turn
+    contents = [{"role": "user", "parts": [SYSTEM_PROMPT]}]
+    
+    if session_id:
+        for turn in _session_turns(session_id, history):
+            role = "user" if turn['role'] == 'user' else "model"
+            contents.append({"role": role, "parts": [turn['content']]})
+    else:
+        for msg in _recent(history):
+            role = "user" if msg['sender'] == 'user' else "model"
+            contents.append({"role": role, "parts": [msg['text']]})
+    
+    contents.append({"role": "user", "parts": [user_msg]})
+    prompt_texts = [content['parts'][0] for content in contents[1:]]
+    contents.append({"role": "user", "parts": [_context_message(repo_context, user_msg, prompt_texts)]})
+    return contents
+
+def _gemini_config(model_name, gen_cfg=None):
+    """Build the Gemini generation and safety settings."""
+    # --- CONFIGURATION LOGIC ---
+    generation_config = {
+        "max_output_tokens": 8000,
+        # Structured output: Gemini returns JSON matching RESPONSE_SCHEMA
+        "response_mime_type": "application/json",
+        "response_schema": RESPONSE_SCHEMA,
+    }
+
+    # 1. Temperature & Thinking Config
+    # Gemini 3 models require high temp and support thinking
+    if "gemini-3" in model_name:
+        generation_config["temperature"] = 1.0 
+        # Note: Only works if the specific preview model supports 'include_thoughts'
+        # generation_config["thinking_config"] = {"include_thoughts": True} 
+    else:
+        # Gemini 2.5/2.0 prefer low temp for coding precision
+        generation_config["temperature"] = 0.2
+
+    # Caller overrides (e.g. temperature=0 + seed for reproducible, cacheable output)
+    generation_config.update(_gen_overrides(gen_cfg))
+
+    # 2. Safety Settings
+    # Set all to BLOCK_ONLY_HIGH to avoid blocking code keywords like "kill", "attack", etc.
+    safety_settings = [
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"},
+    ]
+    return generation_config, safety_settings
+
+def _deepseek_request(model_name, messages, gen_cfg=None):
+    """Keyword arguments for a DeepSeek chat completion."""
+    request = {
+        "model": model_name,
+        "messages": messages,
+        "response_format": { "type": "json_object" },
+        "max_tokens": 8000,
+        "temperature": 0.0 # DeepSeek usually prefers 0 for code
+    }
+    request.update(_gen_overrides(gen_cfg))
+    return request
+
+def _gen_overrides(gen_cfg):
+    """The supported generation parameters set in gen_cfg."""
+    if not gen_cfg:
+        return {}
+    return {k: gen_cfg[k] for k in GEN_CFG_KEYS if gen_cfg.get(k) is not None}
+
+class _JsonObjectScanner:
+    """
+    Incrementally tracks brace depth (ignoring braces inside JSON strings)
+    to spot where the first top-level object in a stream ends.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, chunk):
+        """Return the index just past the object's closing brace in chunk, or None."""
+        for i, char in enumerate(chunk):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                # Strings only matter once we're inside the object
+                self.in_string = self.depth > 0
+            elif char == '{':
+                self.depth += 1
+            elif char == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return None
+
+def _collect_stream(pieces, stream_callback=None):
+    """Join streamed text pieces, stopping as soon as the JSON object is complete."""
+    scanner = _JsonObjectScanner()
+    buf = []
+    for piece in pieces:
+        if not piece:
+            continue
+        if stream_callback:
+            stream_callback(piece)
+        end = scanner.feed(piece)
+        if end is not None:
+            buf.append(piece[:end])
+            break
+        buf.append(piece)
+    return "".join(buf)
+
+async def _collect_stream_async(pieces, stream_callback=None):
+    """Async version of _collect_stream for async iterators of text pieces."""
+    scanner = _JsonObjectScanner()
+    buf = []
+    async for piece in pieces:
+        if not piece:
+            continue
+        if stream_callback:
+            stream_callback(piece)
+        end = scanner.feed(piece)
+        if end is not None:
+            buf.append(piece[:end])
+            break
+        buf.append(piece)
+    return "".join(buf)
+
+def _chunk_text(chunk):
+    """Text of a streamed Gemini chunk; chunks carrying only metadata have none."""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+def _extract_json_object(text):
+    """
+    Return the first top-level JSON object in text in a single linear pass
+    (skips code fences and any trailing chatter). Falls back to the stripped
+    text when there is no complete object, so json.loads reports the error.
+    """
+    start_idx = text.find('{')
+    if start_idx == -1:
+        return text.strip()
+    
+    end = _JsonObjectScanner().feed(text[start_idx:])
+    if end is None:
+        return text[start_idx:]
+    return text[start_idx : start_idx + end]
+
+def _parse_response(text_response):
+    """Extract the JSON object from the raw LLM output (raises JSONDecodeError)."""
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers'
+    # except clauses work with either parser
+    return _loads(_extract_json_object(text_response))
+
+def _api_error_response(error):
+    return {"message": f"Error calling API: {str(error)}", "changes": []}
+
+def _unknown_provider_response(provider):
+    return {"message": f"Error calling API: unknown provider '{provider}'", "changes": []}
+
+def _json_error_response(error, text_response):
+    # Return the raw response if JSON parsing fails for debugging
+    return {
+        "message": f"⚠️ JSON Parse Error: {str(error)}\n\n--- RAW LLM RESPONSE ---\n{text_response}\n--- END RAW RESPONSE ---",
+        "changes": []
+    }
+
+def _start_query(provider, model_name, history, repo_context, user_msg, bypass_cache=False,
+                 session_id=None, gen_cfg=None):
+    """
+    Build the prompt and look it up in the exact and semantic caches.
+    Returns (messages, cached, state): cached is a stored response or None,
+    and state is passed to _finish_query once the provider has answered.
+    """
+    messages = _build_messages(provider, history, repo_context, user_msg, session_id)
+    state = {
+        "key": _cache_key(provider, model_name, messages, gen_cfg),
+        "context_key": _semantic_context_key(provider, model_name, messages, repo_context, gen_cfg),
+        "embedding": None,
+        "user_msg": user_msg,
+        "session_id": session_id,
+    }
+    if bypass_cache:
+        return messages, None, state
+    
+    cached = _CACHE.get(state["key"])
+    if cached is None:
+        state["embedding"] = _embed(user_msg)
+        cached = _semantic_get(state["context_key"], state["embedding"])
+    if cached is not None:
+        _remember_turn(session_id, user_msg, cached)
+    return messages, cached, state
+
+def _finish_query(state, text_response):
+    """Parse the provider's output, then cache it and record the turn."""
+    try:
+        result = _parse_response(text_response)
+    except json.JSONDecodeError as e:
+        return _json_error_response(e, text_response)
+    # Only successful parses are cached; errors should be retried
+    _CACHE.set(state["key"], result, expire=CACHE_TTL_SECONDS)
+    _semantic_put(state["context_key"], state["user_msg"], result, state["embedding"])
+    _remember_turn(state["session_id"], state["user_msg"], result)
+    return result
+
+def query_llm(provider, api_key, model_name, history, repo_context, user_msg, bypass_cache=False,
+              stream_callback=None, session_id=None, gen_cfg=None):
+    """
+    Query the provider and return the parsed {"message", "changes"} dict.
+    The completion is streamed; stream_callback (if given) receives each text
+    piece as it arrives, and reading stops once the JSON object is closed.
+    session_id keeps the chat history server-side (see _build_messages_openai).
+    gen_cfg overrides generation parameters (temperature, top_p, seed).
+    """
+    messages, cached, state = _start_query(provider, model_name, history, repo_context, user_msg,
+                                           bypass_cache, session_id, gen_cfg)
+    if cached is not None:
+        return cached
 
     try:
         if provider == 'gemini':
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(model_name)
-            
-            # Format for Gemini
-            chat_history = []
-            for m in messages:
-                role = "user" if m['role'] in ['user', 'system'] else "model"
-                chat_history.append({"role": role, "parts": [m['content']]})
-            
-            # --- CONFIGURATION LOGIC ---
-            generation_config = {
-                "max_output_tokens": 8000,
-            }
-
-            # 1. Temperature & Thinking Config
-            # Gemini 3 models require high temp and support thinking
-            if "gemini-3" in model_name:
-                generation_config["temperature"] = 1.0 
-                # Note: Only works if the specific preview model supports 'include_thoughts'
-                # generation_config["thinking_config"] = {"include_thoughts": True} 
-            else:
-                # Gemini 2.5/2.0 prefer low temp for coding precision
-                generation_config["temperature"] = 0.2
-
-            # 2. Safety Settings
-            # Set all to BLOCK_ONLY_HIGH to avoid blocking code keywords like "kill", "attack", etc.
-            safety_settings = [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"},
-            ]
+            model = _get_gemini_model(api_key, model_name)
+            generation_config, safety_settings = _gemini_config(model_name, gen_cfg)
             
             response = model.generate_content(
-                chat_history,
+                messages,
                 generation_config=generation_config,
-                safety_settings=safety_settings
+                safety_settings=safety_settings,
+                stream=True,
+                request_options={"retry": _GEMINI_RETRY}
             )
-            text_response = response.text
+            text_response = _collect_stream((_chunk_text(chunk) for chunk in response), stream_callback)
             
         elif provider == 'deepseek':
-            client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                response_format={ "type": "json_object" },
-                max_tokens=8000,
-                temperature=0.0 # DeepSeek usually prefers 0 for code
+            client = _get_deepseek_client(api_key)
+            response = client.chat.completions.create(**_deepseek_request(model_name, messages, gen_cfg), stream=True)
+            try:
+                text_response = _collect_stream(
+                    (chunk.choices[0].delta.content for chunk in response if chunk.choices),
+                    stream_callback
+                )
+            finally:
+                # Drop the connection if we stopped reading early
+                response.close()
+        else:
+            return _unknown_provider_response(provider)
+    except _API_ERRORS as e:
+        return _api_error_response(e)
+
+    return _finish_query(state, text_response)
+
+async def query_llm_async(provider, api_key, model_name, history, repo_context, user_msg, bypass_cache=False,
+                          stream_callback=None, session_id=None, gen_cfg=None):
+    """Async counterpart of query_llm, so many calls can overlap on the network."""
+    # Cache lookups hit the disk and may embed the message; keep them off the event loop
+    messages, cached, state = await asyncio.to_thread(
+        _start_query, provider, model_name, history, repo_context, user_msg,
+        bypass_cache, session_id, gen_cfg
+    )
+    if cached is not None:
+        return cached
+
+    try:
+        if provider == 'gemini':
+            model = _get_gemini_model(api_key, model_name, use_async=True)
+            generation_config, safety_settings = _gemini_config(model_name, gen_cfg)
+            
+            response = await model.generate_content_async(
+                messages,
+                generation_config=generation_config,
+                safety_settings=safety_settings,
+                stream=True,
+                request_options={"retry": _GEMINI_RETRY_ASYNC}
             )
-            text_response = response.choices[0].message.content
+
+            async def pieces():
+                async for chunk in response:
+                    yield _chunk_text(chunk)
+
+            text_response = await _collect_stream_async(pieces(), stream_callback)
             
-        # --- Robust JSON Extraction ---
-        start_idx = text_response.find('{')
-        end_idx = text_response.rfind('}')
+        elif provider == 'deepseek':
+            client = _get_async_deepseek_client(api_key)
+            response = await client.chat.completions.create(**_deepseek_request(model_name, messages, gen_cfg), stream=True)
+
+            async def pieces():
+                async for chunk in response:
+                    if chunk.choices:
+                        yield chunk.choices[0].delta.content
 
-        if start_idx != -1 and end_idx != -1:
-            clean_json = text_response[start_idx : end_idx + 1]
-            return json.loads(clean_json)
+            try:
+                text_response = await _collect_stream_async(pieces(), stream_callback)
+            finally:
+                await response.close()
         else:
-            return json.loads(text_response.strip())
+            return _unknown_provider_response(provider)
+    except _API_ERRORS as e:
+        return _api_error_response(e)
 
-    except json.JSONDecodeError as e:
-        # Return the raw response if JSON parsing fails for debugging
-        return {
-            "message": f"⚠️ JSON Parse Error: {str(e)}\n\n--- RAW LLM RESPONSE ---\n{text_response}\n--- END RAW RESPONSE ---",
-            "changes": []
-        }
-    except Exception as e:
-        return {"message": f"Error calling API: {str(e)}", "changes": []}
+    return await asyncio.to_thread(_finish_query, state, text_response)
+
+async def query_llm_batch(requests, max_concurrency=MAX_CONCURRENT_REQUESTS):
+    """
+    Run several queries concurrently. Each item of requests is a dict of
+    query_llm_async keyword arguments; results come back in the same order.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(kwargs):
+        async with semaphore:
+            return await query_llm_async(**kwargs)
+
+    return await asyncio.gather(*(run(kwargs) for kwargs in requests), return_exceptions=True)